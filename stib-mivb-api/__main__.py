@@ -3,17 +3,31 @@ import os
 import sys
 import json
 import math
+import time
+import threading
+import gzip
+import zlib
 import heapq
+import itertools
 import arrow
 import concurrent.futures
 import urllib.request
 import urllib.parse
+from array import array
 from collections import defaultdict
+from collections import OrderedDict
 from xml.etree import ElementTree
 from flask_api import FlaskAPI
 from flask import request
 from flask import url_for
 from flask import Response
+from flask import stream_with_context
+from flask import g
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 TZ = 'Europe/Brussels'
 TIMEFMT = 'YYYY-MM-DDTHH:mm:ssZZ'
@@ -22,6 +36,32 @@ DEFAULT_MAX_REQUESTS = '10'
 MAX_MAX_REQUESTS = 10
 MAX_NCLOSEST = 30
 TIMEOUT = 5
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_CACHE_SIZE = 4096
+COMPRESS_STATIC_ENDPOINTS = frozenset( (
+    'app_route_network_lines' ,
+    'app_route_network_line' ,
+    'app_route_network_direction' ,
+    'app_route_network_stops' ,
+    'app_route_network_stop' ,
+    'app_route_geojson_stop' ,
+) )
+GZIP_LEVEL_DYNAMIC = 6
+GZIP_LEVEL_STATIC = 9
+BROTLI_QUALITY_DYNAMIC = 5
+BROTLI_QUALITY_STATIC = 11
+STOPS_PER_PAGE = 100
+GRID_CELL = 0.005 # degrees
+EARTH_RADIUS = 6371008.8 # meters
+MAX_RADIUS = 5000 # meters
+ROUTE_CACHE_SIZE = 4096
+TRANSFER = -1
+BOARD_GROUP_BY = ( 'line' , 'destination' , 'mode' )
+RATELIMIT_CAPACITY = 256 # tokens
+RATELIMIT_RATE = 1 # tokens per second
+RATELIMIT_SHARDS = 16
+RATELIMIT_SHARD_SIZE = 1024
+API_KEYS = frozenset( key for key in os.environ.get('API_KEYS', '').split(',') if key )
 
 NETWORK_URL = 'https://raw.githubusercontent.com/aureooms/stib-mivb-network/master/data.json'
 GEOJSON_URL = 'https://gist.githubusercontent.com/C4ptainCrunch/feff3569bc9a677932e61bca7bea5e4c/raw/9a51fdc4487b3827bf7b6fc6d3a199b333ca9c4f/stops.geojson'
@@ -30,8 +70,14 @@ _network = {}
 _geojson = {}
 _stops = {}
 _stops_index = defaultdict(list)
+_stop_ids = []
+_grid = defaultdict(list)
+_graph = None
 _belongs_index = defaultdict(lambda : defaultdict(lambda : defaultdict(lambda :defaultdict( list ))))
 _last_updated = 'never'
+_snapshot = 0
+_compressed = OrderedDict()
+_compressed_lock = threading.Lock()
 
 HDYNAMIC = { 'Cache-Control' :  'no-cache' }
 HSTATIC = { }
@@ -57,10 +103,118 @@ class APIError ( Exception ) :
 class MaxRequestsError ( APIError ) :
     pass
 
+class RateLimitError ( APIError ) :
+
+    def postprocess ( self ) :
+        output = self.json()
+        headers = { }
+        if self.details.get('retry_after') is not None :
+            headers['Retry-After'] = str( self.details['retry_after'] )
+        return postprocess( output , code = self.code , headers = headers )
+
+class RateLimiter ( object ) :
+
+    """
+
+        Token bucket per client. Buckets are spread over shards, each with its
+        own lock, so that concurrent requests of different clients rarely
+        contend. A bucket holds at most `capacity` tokens and regains `rate`
+        tokens per second. A bucket can go negative when a request ends up
+        costing more than what was reserved for it. Each shard keeps at most
+        `shard_size` buckets and forgets the least recently updated first.
+
+    """
+
+    def __init__ ( self , capacity , rate , shards , shard_size ) :
+
+        self.capacity = capacity
+        self.rate = rate
+        self.shard_size = shard_size
+        self.shards = [ ( threading.Lock() , OrderedDict() ) for _ in range( shards ) ]
+
+    def _shard ( self , client ) :
+        return self.shards[hash(client) % len(self.shards)]
+
+    def _refill ( self , bucket , now ) :
+        tokens , updated = bucket
+        return min( self.capacity , tokens + ( now - updated ) * self.rate )
+
+    def _store ( self , buckets , client , tokens , now ) :
+
+        buckets[client] = ( tokens , now )
+        buckets.move_to_end( client )
+
+        if len(buckets) > self.shard_size :
+            buckets.popitem( last = False )
+
+    def _state ( self , tokens ) :
+        reset = time.time() + ( self.capacity - tokens ) / self.rate
+        return self.capacity , max( 0 , int( tokens ) ) , int( math.ceil( reset ) )
+
+    def charge ( self , client , cost , minimum ) :
+
+        """
+
+            Reserve up to `cost` tokens from the bucket of `client`, provided
+            it holds at least `minimum` of them. Returns the number of tokens
+            taken (None if none were), the (limit, remaining, reset) state of
+            the bucket, and the number of seconds until it holds `minimum`
+            tokens (None if it never will).
+
+        """
+
+        now = time.monotonic()
+        lock , buckets = self._shard( client )
+
+        with lock :
+
+            if client in buckets :
+                tokens = self._refill( buckets[client] , now )
+            else :
+                tokens = self.capacity
+
+            if tokens >= minimum :
+                taken = max( minimum , min( cost , int( tokens ) ) )
+                wait = 0
+                tokens -= taken
+            else :
+                taken = None
+                wait = ( minimum - tokens ) / self.rate if minimum <= self.capacity else None
+
+            self._store( buckets , client , tokens , now )
+
+        return taken , self._state( tokens ) , wait
+
+    def settle ( self , client , amount ) :
+
+        """
+
+            Give back `amount` tokens, or take more if `amount` is negative.
+
+        """
+
+        now = time.monotonic()
+        lock , buckets = self._shard( client )
+
+        with lock :
+
+            if client in buckets :
+                tokens = self._refill( buckets[client] , now )
+            else :
+                tokens = self.capacity
+
+            tokens = min( self.capacity , tokens + amount )
+
+            self._store( buckets , client , tokens , now )
+
+        return self._state( tokens )
+
+_ratelimiter = RateLimiter( RATELIMIT_CAPACITY , RATELIMIT_RATE , RATELIMIT_SHARDS , RATELIMIT_SHARD_SIZE )
+
 def _update_network ( ) :
 
-    global _network, _geojson, _stops, _stops_index, _last_updated
-    global _belongs_index, HSTATIC
+    global _network, _geojson, _stops, _stops_index, _stop_ids, _last_updated
+    global _belongs_index, _grid, _graph, _snapshot, HSTATIC
     # retrieve network file
     req = urllib.request.Request(NETWORK_URL)
     req.add_header('Cache-Control', 'max-age=0')
@@ -94,6 +248,26 @@ def _update_network ( ) :
         if stop['longitude'] is not None :
             stop['longitude'] = float(stop['longitude'])
 
+    # stable order for pagination
+    _stop_ids = sorted( _network['stops'] )
+
+    # build uniform lat/lon grid
+    grid = defaultdict(list)
+    for id in _stop_ids :
+        stop = _network['stops'][id]
+        if stop['latitude'] is None or stop['longitude'] is None :
+            continue
+        grid[cell(stop['latitude'], stop['longitude'])].append(id)
+    _grid = grid
+
+    # build line/direction adjacency graph
+    _graph = build_graph()
+
+    # drop precompressed bodies of the previous snapshot
+    with _compressed_lock :
+        _snapshot += 1
+        _compressed.clear()
+
     # update default headers
     _last_updated = arrow.now(TZ).format(TIMEFMT)
     creation = arrow.get(_network['creation'])
@@ -102,6 +276,214 @@ def _update_network ( ) :
         'Last-Modified' :  httpdatefmt(creation)
     }
 
+def cell ( lat , lon ) :
+    return ( math.floor( lat / GRID_CELL ) , math.floor( lon / GRID_CELL ) )
+
+def get_stops_within ( minlat , minlon , maxlat , maxlon ) :
+
+    """
+
+        Only visits the cells of `_grid` overlapping the query.
+
+    """
+
+    grid = _grid
+
+    if not grid :
+        return
+
+    (imin, jmin) , (imax, jmax) = cell(minlat, minlon) , cell(maxlat, maxlon)
+
+    if ( imax - imin + 1 ) * ( jmax - jmin + 1 ) > len(grid) :
+        cells = ( c for c in grid if imin <= c[0] <= imax and jmin <= c[1] <= jmax )
+    else :
+        cells = ( (i, j) for i in range(imin, imax+1) for j in range(jmin, jmax+1) )
+
+    for c in cells :
+        for id in grid.get(c, ()) :
+            stop = _network['stops'][id]
+            if minlat <= stop['latitude'] <= maxlat and minlon <= stop['longitude'] <= maxlon :
+                yield id
+
+def get_stops_near ( lat , lon , radius ) :
+
+    dlat = math.degrees( radius / EARTH_RADIUS )
+    dlon = dlat / max( math.cos( math.radians( lat ) ) , 1e-6 )
+
+    near = [ ]
+
+    for id in get_stops_within( lat - dlat , lon - dlon , lat + dlat , lon + dlon ) :
+        stop = _network['stops'][id]
+        d = EARTH_RADIUS * _dist( lat , lon , stop['latitude'] , stop['longitude'] )
+        if d <= radius :
+            near.append( ( d , id ) )
+
+    near.sort()
+
+    return near
+
+class Graph ( object ) :
+
+    """
+
+        CSR adjacency: the edges leaving node u are
+        targets[offsets[u]:offsets[u+1]], labelled with the index of the
+        (line, direction) in routes they ride, or TRANSFER for a walk between
+        stops sharing a name. Routes found on this graph are memoized in
+        `memo`, so they are dropped along with it.
+
+    """
+
+    def __init__ ( self , ids , index , routes , offsets , targets , labels ) :
+
+        self.ids = ids
+        self.index = index
+        self.routes = routes
+        self.offsets = offsets
+        self.targets = targets
+        self.labels = labels
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+
+def build_graph ( ) :
+
+    ids = _stop_ids
+    index = { id : u for u , id in enumerate( ids ) }
+    edges = [ [ ] for _ in ids ]
+    routes = [ ]
+
+    for line , directions in sorted( _network['itineraries'].items() ) :
+        for direction , stops in sorted( directions.items() ) :
+            r = len(routes)
+            routes.append( ( line , direction ) )
+            for a , b in zip( stops , stops[1:] ) :
+                if a in index and b in index and a != b :
+                    edges[index[a]].append( ( index[b] , r ) )
+
+    for stops in _stops_index.values() :
+        group = [ index[stop['id']] for stop in stops if stop['id'] in index ]
+        for u in group :
+            for v in group :
+                if u != v :
+                    edges[u].append( ( v , TRANSFER ) )
+
+    offsets = array('l', [ 0 ])
+    targets = array('l')
+    labels = array('l')
+
+    for out in edges :
+        for v , r in out :
+            targets.append( v )
+            labels.append( r )
+        offsets.append( len(targets) )
+
+    return Graph( ids , index , routes , offsets , targets , labels )
+
+def get_route ( source , target ) :
+
+    graph = _graph
+    key = ( source , target )
+
+    with graph.lock :
+        if key in graph.memo :
+            graph.memo.move_to_end( key )
+            return graph.memo[key]
+
+    route = find_route( graph , source , target )
+
+    with graph.lock :
+        graph.memo[key] = route
+        if len(graph.memo) > ROUTE_CACHE_SIZE :
+            graph.memo.popitem( last = False )
+
+    return route
+
+def find_route ( graph , source , target ) :
+
+    """
+
+        Fewest-transfer path from source to target, ties broken on the number
+        of stops ridden. Dijkstra over (stop, route) states where boarding
+        costs one ride and riding, alighting and walking are free, so that
+        the fewest rides is the fewest transfers. Returns None if target
+        cannot be reached.
+
+    """
+
+    if source not in graph.index or target not in graph.index :
+        return None
+
+    offsets , targets , labels = graph.offsets , graph.targets , graph.labels
+
+    s , t = graph.index[source] , graph.index[target]
+
+    start = ( s , TRANSFER )
+    best = { start : ( 0 , 0 ) }
+    prev = { start : None }
+    queue = [ ( 0 , 0 , s , TRANSFER ) ]
+
+    while queue :
+
+        boardings , hops , u , r = heapq.heappop( queue )
+
+        if best[(u, r)] < ( boardings , hops ) :
+            continue
+
+        if u == t :
+            break
+
+        moves = [ ]
+
+        for k in range( offsets[u] , offsets[u+1] ) :
+            v , l = targets[k] , labels[k]
+            if l == TRANSFER :
+                if r == TRANSFER :
+                    moves.append( ( boardings , hops , v , TRANSFER ) )
+            elif r == TRANSFER :
+                moves.append( ( boardings + 1 , hops + 1 , v , l ) )
+            elif r == l :
+                moves.append( ( boardings , hops + 1 , v , l ) )
+
+        if r != TRANSFER :
+            moves.append( ( boardings , hops , u , TRANSFER ) )
+
+        for move in moves :
+            state = move[2:]
+            if state not in best or move[:2] < best[state] :
+                best[state] = move[:2]
+                prev[state] = ( u , r )
+                heapq.heappush( queue , move )
+
+    else :
+        return None
+
+    states = [ ]
+    state = ( u , r )
+    while state is not None :
+        states.append( state )
+        state = prev[state]
+    states.reverse()
+
+    legs = [ ]
+    for ( a , _ ) , ( b , l ) in zip( states , states[1:] ) :
+        if a == b :
+            continue
+        if l == TRANSFER :
+            legs.append( { 'type' : 'walk' , 'stops' : [ graph.ids[a] , graph.ids[b] ] } )
+        elif legs and legs[-1]['type'] == 'ride' and legs[-1]['route'] == l :
+            legs[-1]['stops'].append( graph.ids[b] )
+        else :
+            line , direction = graph.routes[l]
+            legs.append( { 'type' : 'ride' , 'route' : l , 'line' : line ,
+                'direction' : direction , 'stops' : [ graph.ids[a] , graph.ids[b] ] } )
+
+    for leg in legs :
+        leg.pop( 'route' , None )
+
+    rides = sum( 1 for leg in legs if leg['type'] == 'ride' )
+
+    return { 'transfers' : max( 0 , rides - 1 ) , 'legs' : legs }
+
 def get_line ( lineid ) :
 
     if lineid is None :
@@ -116,12 +498,82 @@ def get_line ( lineid ) :
 
     return None
 
+def get_client ( request ) :
+
+    # header only, urls end up in response bodies and proxy logs
+    key = request.headers.get('X-API-Key', None)
+
+    if key is not None :
+        if key not in API_KEYS :
+            raise APIError( 'invalid api key' , code = 401 )
+        return 'key:' + key
+
+    # the last forwarded address is the one seen by our own router
+    route = request.access_route
+    return 'ip:' + ( route[-1] if route else str(request.remote_addr) )
+
+def charge ( cost , minimum = None ) :
+
+    """
+
+        Reserve up to `cost` tokens of the current client, typically the
+        number of upstream requests it may trigger, and at least `minimum`
+        (defaults to `cost`). Returns the number of tokens reserved, to be
+        settled against the requests actually sent. Raises RateLimitError if
+        its bucket does not hold `minimum` tokens.
+
+    """
+
+    if minimum is None :
+        minimum = cost
+
+    if getattr( g , 'client' , None ) is None :
+        g.client = get_client( request )
+
+    taken , g.ratelimit , wait = _ratelimiter.charge( g.client , cost , minimum )
+
+    if taken is None :
+
+        limit , remaining , reset = g.ratelimit
+
+        retry_after = None if wait is None else int( math.ceil( wait ) )
+
+        details = {
+            'cost' : minimum ,
+            'limit' : limit ,
+            'remaining' : remaining ,
+            'reset' : reset ,
+            'retry_after' : retry_after ,
+        }
+
+        if minimum > limit :
+            msg = 'request costs at least {} > {} tokens, lower the number of stops'.format(minimum, limit)
+        else :
+            msg = 'rate limit exceeded'
+
+        raise RateLimitError( msg , code = 429 , details = details )
+
+    return taken
+
+def settle ( reserved , sent ) :
+
+    """
+
+        Charge the current client for the `sent` requests it actually made
+        instead of the `reserved` tokens.
+
+    """
+
+    if reserved != sent and getattr( g , 'client' , None ) is not None :
+        g.ratelimit = _ratelimiter.settle( g.client , reserved - sent )
+
 def httpdatefmt ( t ) :
     return t.to('GMT').format(HTTPDATEFMT) + ' GMT'
 
 def postprocess ( output , code = 200 , headers = None ) :
 
-    if headers is None : headers = { }
+    # HSTATIC and HDYNAMIC are shared between concurrent requests
+    headers = { } if headers is None else dict( headers )
 
     date = arrow.now(TZ)
     headers['Date'] = httpdatefmt(date)
@@ -135,9 +587,11 @@ def postprocess ( output , code = 200 , headers = None ) :
 
         headers['Age'] = int( ( date - last_modified ).total_seconds( ) )
 
-    headers['X-RateLimit-Limit'] = '256'
-    headers['X-RateLimit-Remaining'] = '255'
-    headers['X-RateLimit-Reset'] = '0'
+    limit , remaining , reset = getattr( g , 'ratelimit' , ( RATELIMIT_CAPACITY , RATELIMIT_CAPACITY , 0 ) )
+
+    headers['X-RateLimit-Limit'] = str( limit )
+    headers['X-RateLimit-Remaining'] = str( remaining )
+    headers['X-RateLimit-Reset'] = str( reset )
     headers['X-Poll-Interval'] = '0'
 
     headers['X-Frame-Options'] = 'deny'
@@ -151,9 +605,198 @@ def postprocess ( output , code = 200 , headers = None ) :
 
     return output , code , headers
 
+def encodings ( ) :
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def _compress ( data , encoding , static ) :
+
+    if encoding == 'br' :
+        quality = BROTLI_QUALITY_STATIC if static else BROTLI_QUALITY_DYNAMIC
+        return brotli.compress( data , quality = quality )
+
+    level = GZIP_LEVEL_STATIC if static else GZIP_LEVEL_DYNAMIC
+    return gzip.compress( data , compresslevel = level )
+
+def precompressed_key ( encoding ) :
+
+    """
+
+        Key of the current request in `_compressed`, or None if its body is
+        not a fixed snapshot resource. Only JSON renderings of the endpoints
+        in COMPRESS_STATIC_ENDPOINTS without query parameters qualify.
+
+    """
+
+    snapshot = getattr( g , 'snapshot' , None )
+
+    if snapshot is None or request.method != 'GET' :
+        return None
+
+    if request.endpoint not in COMPRESS_STATIC_ENDPOINTS :
+        return None
+
+    if request.args :
+        return None
+
+    if request.accept_mimetypes.best_match( [ 'application/json' , 'text/html' ] ) != 'application/json' :
+        return None
+
+    args = tuple( sorted( request.view_args.items() ) )
+
+    # bodies embed the host in their urls
+    return ( snapshot , request.endpoint , args , request.host_url , encoding )
+
+def serve_precompressed ( ) :
+
+    """
+
+        Serve a snapshot resource compressed by an earlier request without
+        rendering it again.
+
+    """
+
+    g.snapshot = _snapshot
+
+    encoding = request.accept_encodings.best_match( encodings() )
+
+    if encoding is None :
+        return None
+
+    key = precompressed_key( encoding )
+
+    if key is None :
+        return None
+
+    with _compressed_lock :
+        data = _compressed.get( key )
+        if data is not None :
+            _compressed.move_to_end( key )
+
+    if data is None :
+        return None
+
+    _ , code , headers = postprocess( None , headers = HSTATIC )
+
+    headers['Content-Encoding'] = encoding
+    headers['Vary'] = 'Accept-Encoding'
+
+    return Response( data , status = code , headers = headers , mimetype = 'application/json' )
+
+def compress ( response ) :
+
+    """
+
+        Content negotiation for gzip and brotli. Snapshot resources are
+        compressed at the highest level on their first hit and stored in
+        `_compressed`, from which `serve_precompressed` answers afterwards.
+        Everything else is compressed at the dynamic level and not stored.
+
+    """
+
+    if response.direct_passthrough or response.is_streamed :
+        return response
+
+    if response.status_code < 200 or response.status_code in ( 204 , 304 ) :
+        return response
+
+    if 'Content-Encoding' in response.headers :
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = request.accept_encodings.best_match( encodings() )
+
+    if encoding is None :
+        return response
+
+    body = response.get_data()
+
+    if len(body) < COMPRESS_MIN_SIZE :
+        return response
+
+    key = None
+
+    if response.status_code == 200 and response.mimetype == 'application/json' :
+        key = precompressed_key( encoding )
+
+    if key is None :
+        data = _compress( body , encoding , False )
+
+    else :
+        data = _compress( body , encoding , True )
+        with _compressed_lock :
+            _compressed[key] = data
+            if len(_compressed) > COMPRESS_CACHE_SIZE :
+                _compressed.popitem( last = False )
+
+    response.set_data( data )
+    response.headers['Content-Encoding'] = encoding
+
+    return response
+
+def _gzip_stream ( chunks ) :
+
+    compressor = zlib.compressobj( GZIP_LEVEL_DYNAMIC , zlib.DEFLATED , 16 + zlib.MAX_WBITS )
+
+    for chunk in chunks :
+        data = compressor.compress( chunk )
+        if data : yield data
+
+    yield compressor.flush()
+
+def stream ( chunks , mimetype , headers ) :
+
+    """
+
+        Stream a lazily generated body with chunked encoding. `compress`
+        skips streamed responses so gzip is negotiated here instead.
+
+    """
+
+    _ , code , headers = postprocess( None , headers = dict(headers) )
+
+    headers['Vary'] = 'Accept-Encoding'
+
+    chunks = ( chunk.encode() for chunk in chunks )
+
+    if request.accept_encodings.best_match( [ 'gzip' ] ) is not None :
+        chunks = _gzip_stream( chunks )
+        headers['Content-Encoding'] = 'gzip'
+
+    chunks = stream_with_context( chunks )
+
+    return Response( chunks , status = code , headers = headers , mimetype = mimetype )
+
+def feature_collection ( features ) :
+
+    yield '{"type": "FeatureCollection", "features": ['
+
+    sep = ''
+
+    for feature in features :
+        yield sep + json.dumps( feature )
+        sep = ', '
+
+    yield ']}'
+
 
 app = FlaskAPI(__name__)
 
+app.after_request(compress)
+
+@app.errorhandler(APIError)
+def app_errorhandler_apierror(e):
+    return e.postprocess()
+
+@app.before_request
+def app_before_request():
+    try:
+        charge( 1 )
+    except APIError as e :
+        return e.postprocess()
+
+app.before_request(serve_precompressed)
+
 app.config['DEFAULT_RENDERERS'] = [
     'flask_api.renderers.JSONRenderer',
     'flask_api.renderers.BrowsableAPIRenderer',
@@ -267,7 +910,221 @@ def app_route_network_direction(id,direction):
 @app.route('/network/stops/', defaults={'page': 1})
 @app.route('/network/stops/page/<int:page>')
 def app_route_network_stops(page):
-    return { 'message' : 'not implemented yet' } , 404
+
+    pages = max( 1 , -( -len(_stop_ids) // STOPS_PER_PAGE ) )
+
+    if page < 1 or page > pages :
+        return APIError( 'page does not exist' , code = 404 ).postprocess()
+
+    root = request.host_url.rstrip('/')
+
+    begin = ( page - 1 ) * STOPS_PER_PAGE
+    end = begin + STOPS_PER_PAGE
+
+    stops = [ ]
+
+    for id in _stop_ids[begin:end] :
+
+        data = _network['stops'][id]
+
+        stop = {
+            'id' : id ,
+            'name' : data['name'] ,
+            'latitude' : data['latitude'] ,
+            'longitude' : data['longitude'] ,
+            'url' : root + url_for('app_route_network_stop', id = id) ,
+        }
+
+        stops.append(stop)
+
+    links = {
+        'first' : root + url_for('app_route_network_stops', page = 1) ,
+        'last' : root + url_for('app_route_network_stops', page = pages) ,
+        'geojson' : root + url_for('app_route_geojson_stops') ,
+    }
+
+    if page > 1 :
+        links['prev'] = root + url_for('app_route_network_stops', page = page - 1)
+
+    if page < pages :
+        links['next'] = root + url_for('app_route_network_stops', page = page + 1)
+
+    output = {
+        'url' : root + url_for('app_route_network_stops', page = page) ,
+        'page' : page ,
+        'pages' : pages ,
+        'links' : links ,
+        'stops' : stops ,
+    }
+
+    return postprocess( output , headers = HSTATIC )
+
+def get_float ( request , name ) :
+
+    _value = request.args.get(name,None)
+
+    if _value is None :
+        raise APIError( 'missing {} argument'.format(name) , code = 400 )
+
+    try :
+        value = float(_value)
+    except:
+        raise APIError( 'incorrect {} parameter'.format(name) , code = 400 )
+
+    if not math.isfinite(value) :
+        raise APIError( 'incorrect {} parameter'.format(name) , code = 400 )
+
+    return value
+
+def get_realtime_flag ( request ) :
+    return request.args.get('realtime','0').lower() in ( '1' , 'true' , 'yes' )
+
+def stops_output ( ids , realtime , extra = None ) :
+
+    """
+
+        Static stop data, with realtime attached only when asked for.
+
+    """
+
+    if realtime and len(ids) > MAX_NCLOSEST :
+        msg = 'realtime is limited to {} stops, narrow the query'.format(MAX_NCLOSEST)
+        raise APIError( msg , code = 400 )
+
+    root = request.host_url.rstrip('/')
+
+    stops = [ ]
+
+    for i , id in enumerate( ids ) :
+
+        data = _network['stops'][id]
+
+        stop = {
+            'id' : id ,
+            'name' : data['name'] ,
+            'latitude' : data['latitude'] ,
+            'longitude' : data['longitude'] ,
+            'url' : root + url_for('app_route_network_stop', id = id) ,
+        }
+
+        if extra is not None :
+            stop.update( extra[i] )
+
+        stops.append( stop )
+
+    if realtime :
+
+        max_requests = get_max_requests( request )
+        board = get_board( request )
+
+        queries = [ ( id , _network['waiting'][id] ) for id in ids if _network['waiting'].get(id) ]
+
+        if queries :
+            realtimes = dict( get_realtime_stops( queries , max_requests , board ) )
+            for stop in stops :
+                if stop['id'] in realtimes :
+                    stop['realtime'] = realtimes[stop['id']]
+
+    return stops
+
+@app.route("/network/stops/within")
+def app_route_network_stops_within():
+
+    try:
+        bbox = get_bbox( request )
+        if bbox is None :
+            raise APIError( 'missing bbox argument' , code = 400 )
+        minlon , minlat , maxlon , maxlat = bbox
+        realtime = get_realtime_flag( request )
+        ids = sorted( get_stops_within( minlat , minlon , maxlat , maxlon ) )
+        stops = stops_output( ids , realtime )
+    except APIError as e :
+        return e.postprocess()
+
+    output = {
+        'url' : request.url ,
+        'bbox' : list( bbox ) ,
+        'stops' : stops ,
+    }
+
+    return postprocess( output , headers = HDYNAMIC if realtime else HSTATIC )
+
+@app.route("/network/stops/near")
+def app_route_network_stops_near():
+
+    try:
+        lat = get_float( request , 'lat' )
+        lon = get_float( request , 'lon' )
+        check_latlon( lat , lon )
+        radius = get_float( request , 'radius' )
+        if radius < 0 :
+            raise APIError( 'radius must be >= 0' , code = 400 )
+        if radius > MAX_RADIUS :
+            raise APIError( 'radius must be <= {}'.format(MAX_RADIUS) , code = 400 )
+        realtime = get_realtime_flag( request )
+        near = get_stops_near( lat , lon , radius )
+        ids = [ id for _ , id in near ]
+        extra = [ { 'distance' : d } for d , _ in near ]
+        stops = stops_output( ids , realtime , extra = extra )
+    except APIError as e :
+        return e.postprocess()
+
+    output = {
+        'url' : request.url ,
+        'latitude' : lat ,
+        'longitude' : lon ,
+        'radius' : radius ,
+        'stops' : stops ,
+    }
+
+    return postprocess( output , headers = HDYNAMIC if realtime else HSTATIC )
+
+@app.route("/network/route/<source>/<target>")
+def app_route_network_route(source, target):
+
+    if source not in _network['stops'] :
+        return APIError( 'source stop does not exist' , code = 404 ).postprocess()
+
+    if target not in _network['stops'] :
+        return APIError( 'target stop does not exist' , code = 404 ).postprocess()
+
+    route = get_route( source , target )
+
+    if route is None :
+        return APIError( 'no route between these stops' , code = 404 ).postprocess()
+
+    root = request.host_url.rstrip('/')
+
+    stopurl = lambda id : root + url_for('app_route_network_stop', id = id)
+
+    legs = [ ]
+
+    for _leg in route['legs'] :
+
+        leg = {
+            'type' : _leg['type'] ,
+            'from' : { 'id' : _leg['stops'][0] , 'url' : stopurl( _leg['stops'][0] ) } ,
+            'to' : { 'id' : _leg['stops'][-1] , 'url' : stopurl( _leg['stops'][-1] ) } ,
+            'stops' : _leg['stops'] ,
+        }
+
+        if _leg['type'] == 'ride' :
+            leg['line'] = _leg['line']
+            leg['direction'] = _leg['direction']
+            leg['url'] = root + url_for('app_route_network_direction',
+                    id = _leg['line'] , direction = _leg['direction'] )
+
+        legs.append( leg )
+
+    output = {
+        'url' : root + url_for('app_route_network_route', source = source , target = target ) ,
+        'from' : { 'id' : source , 'url' : stopurl( source ) } ,
+        'to' : { 'id' : target , 'url' : stopurl( target ) } ,
+        'transfers' : route['transfers'] ,
+        'legs' : legs ,
+    }
+
+    return postprocess( output , headers = HSTATIC )
 
 @app.route("/network/stop/<id>")
 def app_route_network_stop(id):
@@ -350,6 +1207,122 @@ def app_route_geojson_stop(id):
 
     return postprocess( _stops[id] , headers = HSTATIC )
 
+def check_latlon ( lat , lon ) :
+
+    if not -90 <= lat <= 90 :
+        raise APIError( 'latitude must be within [-90, 90]' , code = 400 )
+
+    if not -180 <= lon <= 180 :
+        raise APIError( 'longitude must be within [-180, 180]' , code = 400 )
+
+def get_bbox ( request ) :
+
+    _bbox = request.args.get('bbox',None)
+
+    if _bbox is None :
+        return None
+
+    try :
+        minlon , minlat , maxlon , maxlat = map( float , _bbox.split(',') )
+    except:
+        raise APIError( 'incorrect bbox parameter, expected minlon,minlat,maxlon,maxlat' , code = 400 )
+
+    if not all( map( math.isfinite , ( minlon , minlat , maxlon , maxlat ) ) ) :
+        raise APIError( 'incorrect bbox parameter, expected finite values' , code = 400 )
+
+    check_latlon( minlat , minlon )
+    check_latlon( maxlat , maxlon )
+
+    if minlon > maxlon or minlat > maxlat :
+        raise APIError( 'bbox must satisfy minlon <= maxlon and minlat <= maxlat' , code = 400 )
+
+    return minlon , minlat , maxlon , maxlat
+
+def stop_feature ( id ) :
+
+    data = _network['stops'][id]
+
+    return {
+        'type' : 'Feature' ,
+        'geometry' : {
+            'type' : 'Point' ,
+            'coordinates' : [ data['longitude'] , data['latitude'] ] ,
+        } ,
+        'properties' : {
+            'stop_id' : id ,
+            'name' : data['name'] ,
+        } ,
+    }
+
+def stop_features ( bbox ) :
+
+    if bbox is None :
+        ids = ( id for id in _stop_ids
+            if _network['stops'][id]['latitude'] is not None
+            and _network['stops'][id]['longitude'] is not None )
+
+    else :
+        minlon , minlat , maxlon , maxlat = bbox
+        ids = get_stops_within( minlat , minlon , maxlat , maxlon )
+
+    for id in ids :
+        yield stop_feature( id )
+
+def itinerary_features ( ) :
+
+    for line , directions in _network['itineraries'].items() :
+
+        data = _network['lines'].get(line, { })
+
+        for direction , stops in directions.items() :
+
+            coordinates = [ ]
+
+            for id in stops :
+                stop = _network['stops'].get(id)
+                if stop is None or stop['latitude'] is None or stop['longitude'] is None :
+                    continue
+                coordinates.append( [ stop['longitude'] , stop['latitude'] ] )
+
+            if len(coordinates) < 2 :
+                continue
+
+            yield {
+                'type' : 'Feature' ,
+                'geometry' : {
+                    'type' : 'LineString' ,
+                    'coordinates' : coordinates ,
+                } ,
+                'properties' : {
+                    'line' : line ,
+                    'direction' : direction ,
+                    'destination' : data.get('destination' + direction) ,
+                    'mode' : data.get('mode') ,
+                    'fgcolor' : data.get('fgcolor') ,
+                    'bgcolor' : data.get('bgcolor') ,
+                    'stops' : stops ,
+                } ,
+            }
+
+@app.route("/geojson/stops/")
+def app_route_geojson_stops():
+
+    try:
+        bbox = get_bbox( request )
+    except APIError as e :
+        return e.postprocess()
+
+    features = stop_features( bbox )
+
+    return stream( feature_collection( features ) , 'application/json' , HSTATIC )
+
+@app.route("/geojson/itineraries/")
+def app_route_geojson_itineraries():
+
+    features = itinerary_features( )
+
+    return stream( feature_collection( features ) , 'application/json' , HSTATIC )
+
 def get_max_requests ( request ) :
 
     _max_requests = request.args.get('max_requests',DEFAULT_MAX_REQUESTS)
@@ -367,6 +1340,114 @@ def get_max_requests ( request ) :
 
     return max_requests
 
+class Board ( object ) :
+
+    """
+
+        Departure-board view of realtime results: waiting times are filtered
+        by line and mode, grouped on `group_by` and only the next `limit`
+        departures of each group are kept, using a bounded heap per group.
+
+    """
+
+    def __init__ ( self , group_by , limit , lines , modes ) :
+
+        self.group_by = group_by
+        self.limit = limit
+        self.lines = lines
+        self.modes = modes
+
+    def accepts ( self , waitingtime ) :
+
+        if self.lines is not None and waitingtime['line'] not in self.lines :
+            return False
+
+        if self.modes is not None and ( waitingtime['mode'] or '' ).upper() not in self.modes :
+            return False
+
+        return True
+
+    def key ( self , waitingtime ) :
+        return tuple( waitingtime[field] for field in self.group_by )
+
+    def push ( self , group , at , seq , waitingtime ) :
+
+        entry = ( -at , seq , waitingtime )
+
+        if self.limit is None or len(group) < self.limit :
+            heapq.heappush( group , entry )
+
+        elif entry > group[0] :
+            heapq.heapreplace( group , entry )
+
+    def departures ( self , group ) :
+        return [ w for _ , _ , w in sorted( group , key = lambda e : ( -e[0] , e[1] ) ) ]
+
+    def output ( self , groups ) :
+
+        groups = [ ( key , self.departures( group ) ) for key , group in groups.items() ]
+
+        if not self.group_by :
+            return { 'results' : groups[0][1] if groups else [ ] }
+
+        groups.sort( key = lambda g : g[1][0]['when'] )
+
+        output = [ ]
+
+        for key , departures in groups :
+            group = dict( zip( self.group_by , key ) )
+            group['departures'] = departures
+            output.append( group )
+
+        return { 'groups' : output }
+
+def _get_list ( request , name ) :
+
+    _value = request.args.get(name,None)
+
+    if _value is None :
+        return None
+
+    values = [ x.strip() for x in _value.split(',') if x.strip() ]
+
+    # an empty parameter means no filter
+    return values if values else None
+
+def get_board ( request ) :
+
+    group_by = _get_list( request , 'group_by' )
+    limit = request.args.get('limit_per_group',None)
+    lines = _get_list( request , 'line' )
+    modes = _get_list( request , 'mode' )
+
+    if group_by is None and limit is None and lines is None and modes is None :
+        return None
+
+    group_by = ( ) if group_by is None else tuple( group_by )
+
+    for field in group_by :
+        if field not in BOARD_GROUP_BY :
+            msg = 'group_by must be a subset of {}'.format(','.join(BOARD_GROUP_BY))
+            raise APIError( msg , code = 400 )
+
+    if limit is not None :
+
+        try :
+            limit = int(limit)
+        except:
+            raise APIError( 'incorrect limit_per_group parameter' , code = 400 )
+
+        if limit < 1 :
+            raise APIError( 'limit_per_group must be >= 1' , code = 400 )
+
+    if lines is not None :
+        lines = set( lines )
+
+    if modes is not None :
+        modes = set( mode.upper() for mode in modes )
+
+    return Board( group_by , limit , lines , modes )
+
 
 @app.route("/realtime/stop/<id>")
 def app_route_realtime_stop(id = None):
@@ -376,9 +1457,10 @@ def app_route_realtime_stop(id = None):
 
     try:
         max_requests = get_max_requests( request )
+        board = get_board( request )
         halts = _network['waiting'][id]
         query = ( id, halts )
-        _ , realtime = next(get_realtime_stops([query], max_requests))
+        _ , realtime = next(get_realtime_stops([query], max_requests, board))
     except APIError as e :
         return e.postprocess()
 
@@ -431,6 +1513,20 @@ def load_url(parse, url, max_requests = 1, timeout = 60) :
     now = arrow.now(TZ)
     raise LoadUrlException( now , requests )
 
+def load_url_charged(parse, url, max_requests = 1, timeout = 60) :
+
+    reserved = charge( max_requests , minimum = 1 )
+
+    try:
+        result = load_url( parse , url , max_requests = max_requests , timeout = timeout )
+    except LoadUrlException as e :
+        settle( reserved , len( e.requests ) )
+        raise
+
+    settle( reserved , len( result.requests ) )
+
+    return result
+
 def query_realtime_stops(queries, max_requests):
 
     REQUEST = 'http://m.stib.be/api/getwaitingtimes.php?halt={}'
@@ -468,9 +1564,15 @@ def query_realtime_stops(queries, max_requests):
 
             yield key , future
 
-def get_realtime_stops(queries, max_requests):
+def get_realtime_stops(queries, max_requests, board = None):
+
+    # at least one request per halt, at most max_requests
+    nhalts = sum( len( halts ) for _ , halts in queries )
+    reserved = charge( max_requests * nhalts , minimum = nhalts )
 
     results = defaultdict(list)
+    groups = defaultdict(lambda : defaultdict(list))
+    seq = itertools.count()
     sources = defaultdict(dict)
     ok = { id : False for id, _ in queries }
 
@@ -520,7 +1622,8 @@ def get_realtime_stops(queries, max_requests):
 
                 else:
 
-                    when = result.date.replace(minutes=+minutes).format(TIMEFMT)
+                    at = result.date.replace(minutes=+minutes)
+                    when = at.format(TIMEFMT)
 
                     line = get_line( lineid )
                     if line is not None :
@@ -530,7 +1633,7 @@ def get_realtime_stops(queries, max_requests):
                         bgcolor = "#000000"
                         fgcolor = "#FFFFFF"
 
-                    results[id].append({
+                    waitingtime = {
                         'stop' : id ,
                         'line' : lineid ,
                         'mode' : mode ,
@@ -540,7 +1643,18 @@ def get_realtime_stops(queries, max_requests):
                         'minutes' : minutes ,
                         'fgcolor' : fgcolor ,
                         'bgcolor' : bgcolor
-                    })
+                    }
+
+                    if board is None :
+                        results[id].append(waitingtime)
+
+                    elif board.accepts(waitingtime) :
+                        group = groups[id][board.key(waitingtime)]
+                        board.push(group, at.float_timestamp, next(seq), waitingtime)
+
+    # charge the requests actually sent
+    sent = sum( len( source['requests'] ) for halts in sources.values() for source in halts.values() )
+    settle( reserved , sent )
 
     if not any(ok.values()) :
         msg = 'failed to fetch realtime'
@@ -556,13 +1670,21 @@ def get_realtime_stops(queries, max_requests):
             msg = 'failed to fetch realtime for {}'.format(id)
             yield id , MaxRequestError( msg , code = 503 , details = sources[id] ).json()
 
-        else:
+        elif board is None :
             yield id , {
                 'url' : root + url_for('app_route_realtime_stop', id = id) ,
                 'sources' : sources[id] ,
                 'results' : results[id]
             }
 
+        else:
+            output = {
+                'url' : root + url_for('app_route_realtime_stop', id = id) ,
+                'sources' : sources[id] ,
+            }
+            output.update( board.output( groups[id] ) )
+            yield id , output
+
 
 def _dist ( lat1 , lon1 , lat2 , lon2 , sqrt = math.sqrt, rad = math.radians, atan = math.atan2 , sin = math.sin , cos = math.cos ) :
 
@@ -621,7 +1743,7 @@ def app_route_control_lines():
 
     try:
 
-        result = load_url(
+        result = load_url_charged(
                 lambda conn: json.loads(conn.read().decode()) ,
                 REQUEST ,
                 max_requests = max_requests ,
@@ -670,7 +1792,7 @@ def app_route_control_last():
 
     try:
 
-        result = load_url(
+        result = load_url_charged(
                 lambda conn: json.loads(conn.read().decode()) ,
                 REQUEST ,
                 max_requests = max_requests ,
@@ -746,6 +1868,7 @@ def get_realtime_nclosest(lat, lon, n = 1):
         raise APIError( 'incorrect lon parameter' , code = 400 )
 
     max_requests = get_max_requests( request )
+    board = get_board( request )
 
     # SLOW AND STUPID
     localdist = lambda stop : dist(_lat,_lon,stop['latitude'],stop['longitude'])
@@ -758,7 +1881,7 @@ def get_realtime_nclosest(lat, lon, n = 1):
     # TODO find a better representative id than [0] (maybe the closest in the list?)
     queries = [ (_stops_index[name][0]['id'], [ x['id'] for x in _stops_index[name] ]) for name in nclosest]
 
-    for id , realtime in get_realtime_stops(queries, max_requests):
+    for id , realtime in get_realtime_stops(queries, max_requests, board):
 
         data = _network['stops'][id]
 